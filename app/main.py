@@ -4,6 +4,8 @@ load_dotenv()
 
 import os
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
 from database.db import engine
 from database import models
 from routers import apartments
@@ -12,24 +14,46 @@ from routers import user
 from routers import auth
 from starlette.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
-models.Base.metadata.create_all(bind=engine)
+if os.getenv("AUTO_CREATE_TABLES") == "1":
+    models.Base.metadata.create_all(bind=engine)
 
 
-origins = os.getenv("CORS_ORIGIN_SERVER")
+origins = tuple(
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGIN_SERVER", "").split(",")
+    if origin.strip()
+)
 
+# CORSMiddleware is pure ASGI. Any middleware added here should be too
+# (an __call__(scope, receive, send) class), not BaseHTTPMiddleware or
+# @app.middleware("http"), which wrap every request in an extra task.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 prefix = "/api/v1"
 
+
 app.include_router(apartments.router, prefix=prefix)
 app.include_router(listings.router, prefix=prefix)
 app.include_router(user.router, prefix=prefix)
 app.include_router(auth.router, prefix=prefix)
+
+
+@app.on_event("startup")
+async def compute_dummy_password_hash():
+    await run_in_threadpool(auth.get_dummy_password_hash)
+
+
+@app.on_event("shutdown")
+async def close_shared_resources():
+    await apartments.http_client.aclose()
+    auth.shutdown_hash_pool()
+    listings.shutdown_encode_pool()
@@ -4,9 +4,47 @@ dotenv.load_dotenv()
 
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-engine = create_engine(os.getenv("SQLALCHEMY_DATABASE_URI"), echo=True)
+database_url = make_url(os.getenv("SQLALCHEMY_DATABASE_URI"))
+echo = os.getenv("SQL_ECHO", "").lower() == "true"
+
+# Each worker process holds its own pools, so one worker can open up to
+# pool_size + max_overflow of each. Keep workers * (sync + async) under
+# Postgres's max_connections (100 by default). The hot routes use the async
+# engine, while the sync one serves the threadpool routes and background tasks
+pool_size = int(os.getenv("DB_POOL_SIZE", "5"))
+max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+async_pool_size = int(os.getenv("ASYNC_DB_POOL_SIZE", "5"))
+async_max_overflow = int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "5"))
+
+engine = create_engine(
+    database_url,
+    echo=echo,
+    pool_size=pool_size,
+    max_overflow=max_overflow,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    query_cache_size=1200,
+)
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+
+async_engine = create_async_engine(
+    database_url.set(drivername="postgresql+asyncpg"),
+    echo=echo,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=async_pool_size,
+    max_overflow=async_max_overflow,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
 Base = declarative_base()
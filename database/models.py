@@ -6,11 +6,14 @@ from sqlalchemy import Column
 from sqlalchemy import Date
 from sqlalchemy import Float
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import text
 from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm import validates
 from sqlalchemy.sql.sqltypes import DateTime
 
 from database.db import Base
@@ -18,6 +21,7 @@ from database.db import Base
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (Index("ix_users_email_lower", text("lower(email)"), unique=True),)
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name = Column(String(50), nullable=False)
@@ -30,12 +34,22 @@ class User(Base):
     verify_user = Column(Boolean, default=False)
     verification_email_resend_count = Column(Integer, default=0)
 
+    @validates("email")
+    def normalize_email(self, key, email):
+        # Stored lower cased so the unique constraint on email matches lookups
+        return email.lower()
+
     def __repr__(self) -> str:
         return f"User({self.email})"
 
 
 class Apartment(Base):
     __tablename__ = "apartments"
+    __table_args__ = (
+        Index("ix_apartments_name", "name"),
+        Index("ix_apartments_name_token_gin", "name_token", postgresql_using="gin"),
+        Index("ix_apartments_pincode", "pincode"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name = Column(String(100), nullable=False)
@@ -52,6 +66,18 @@ class Apartment(Base):
 
 class Listing(Base):
     __tablename__ = "listings"
+    __table_args__ = (
+        Index("ix_listings_user_apartment", "user_id", "apartment_id"),
+        Index(
+            "ix_listings_apartment_type_bedrooms",
+            "apartment_id",
+            "listing_type",
+            "bedrooms",
+        ),
+        Index(
+            "ix_listings_date_created_id", text("date_created DESC"), text("id DESC")
+        ),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     title = Column(String(200), nullable=False)
@@ -67,8 +93,8 @@ class Listing(Base):
     brokers_excuse = Column(Boolean)
     pets_allowed = Column(Boolean)
     available_from = Column(String(10))
-    user_id = Column(UUID, ForeignKey("users.id"))
-    apartment_id = Column(UUID, ForeignKey("apartments.id"))
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"))
+    apartment_id = Column(UUID(as_uuid=True), ForeignKey("apartments.id"))
     date_created = Column(Date, default=date.today)
     rent_amount = Column(Float)
     maintenance_amount = Column(Float)
@@ -87,6 +113,7 @@ class Listing(Base):
 
     user = relationship("User")
     apartment = relationship("Apartment")
+    images = relationship("ListingImage", back_populates="listing")
 
     def __repr__(self) -> str:
         return f"Listing({self.title})"
@@ -95,16 +122,36 @@ class Listing(Base):
 class ListingImage(Base):
 
     __tablename__ = "listingimages"
+    # The image queries filter on listing_id and read the columns included
+    # here, so Postgres can answer them with an index-only scan once the
+    # visibility map is current (i.e. after autovacuum has caught up with
+    # recent writes). Until then it still visits the heap. The second index
+    # serves the deletes of a single image by its ImageKit file id
+    __table_args__ = (
+        Index("ix_listingimages_imagekit_file_id", "imagekit_file_id"),
+        Index(
+            "ix_listingimages_listing_id",
+            "listing_id",
+            postgresql_include=[
+                "id",
+                "imagekit_file_id",
+                "image_path",
+                "height",
+                "width",
+                "thumbnail_url",
+            ],
+        ),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    listing_id = Column(UUID, ForeignKey("listings.id"))
+    listing_id = Column(UUID(as_uuid=True), ForeignKey("listings.id"))
     imagekit_file_id = Column(String(100))
     image_path = Column(String(200), nullable=False)
     height = Column(Integer)
     width = Column(Integer)
     thumbnail_url = Column(String(200))
 
-    listing = relationship("Listing")
+    listing = relationship("Listing", back_populates="images")
 
     def __repr__(self) -> str:
         return f"ListingImage({self.listing_id}, {self.image_path})"
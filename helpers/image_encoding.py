@@ -0,0 +1,71 @@
+import io
+import os
+
+from PIL import Image
+
+# The encode pool's spawned workers import this module to run encode_image,
+# so it must stay free of imports that open connections or build engines
+
+# Uploads larger than this are scaled down, keeping their aspect ratio
+MAX_IMAGE_SIZE = (1920, 1920)
+
+# Well above any phone camera, far below a decompression bomb
+MAX_UPLOAD_PIXELS = 50_000_000
+Image.MAX_IMAGE_PIXELS = MAX_UPLOAD_PIXELS
+
+# Pillow format an upload is stored in, by its file extension
+IMAGE_FORMATS = {
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".png": "PNG",
+    ".webp": "WEBP",
+    ".gif": "GIF",
+}
+
+# Multi-picture JPEGs from phones open as MPO but are saved as plain JPEG
+DECODED_FORMATS = {"MPO": "JPEG"}
+
+# Modes JPEG can store, anything else is converted to RGB before saving
+JPEG_MODES = ("RGB", "L", "CMYK")
+
+# optimize=True costs an extra encoding pass for a few percent of size
+IMAGE_SAVE_OPTIONS = {"JPEG": {"quality": 85, "progressive": True}}
+
+
+def image_format(filename: str):
+    return IMAGE_FORMATS.get(os.path.splitext(filename)[1].lower())
+
+
+def encode_image(filename: str, data: bytes):
+    # Runs in the listings router's encode pool
+    image_fmt = image_format(filename)
+
+    with Image.open(io.BytesIO(data)) as optimized_image:
+        # optimized_image = fix_image_orientation(optimized_image)
+
+        # Files that are already in the target format, small enough and carry
+        # no EXIF (which can include the phone's location) are uploaded
+        # untouched
+        if (
+            optimized_image.format == image_fmt
+            and optimized_image.width <= MAX_IMAGE_SIZE[0]
+            and optimized_image.height <= MAX_IMAGE_SIZE[1]
+            and "exif" not in optimized_image.info
+        ):
+            return data
+
+        # Called before the pixels are loaded so JPEGs are scaled down by the
+        # decoder and the image is only decoded once
+        optimized_image.thumbnail(MAX_IMAGE_SIZE)
+
+        if image_fmt == "JPEG" and optimized_image.mode not in JPEG_MODES:
+            optimized_image = optimized_image.convert("RGB")
+
+        in_mem_file = io.BytesIO()
+        optimized_image.save(
+            in_mem_file,
+            format=image_fmt,
+            **IMAGE_SAVE_OPTIONS.get(image_fmt, {}),
+        )
+
+        return in_mem_file.getvalue()
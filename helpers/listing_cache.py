@@ -0,0 +1,56 @@
+from threading import Lock
+
+from cachetools import TTLCache
+
+# Per worker caches, dropped by invalidate_listing_caches on every write.
+# There is no shared cache backend in this stack, so the invalidation only
+# reaches the worker that handled the write. Every other worker can serve a
+# stale or deleted listing until its entry expires, at most the 60s TTL. A
+# shared backend would have to replace these before the TTL is raised
+_listing_cache = TTLCache(maxsize=1000, ttl=60)
+_listing_list_cache = TTLCache(maxsize=100, ttl=60)
+# A user's listings and dashboard counts, keyed by (route, user_id)
+_user_listings_cache = TTLCache(maxsize=1000, ttl=60)
+_cache_lock = Lock()
+
+
+def get_cached_listing(key: str):
+    with _cache_lock:
+        return _listing_cache.get(key)
+
+
+def cache_listing(key: str, value):
+    with _cache_lock:
+        _listing_cache[key] = value
+
+
+def get_cached_listings(key: tuple):
+    with _cache_lock:
+        return _listing_list_cache.get(key)
+
+
+def cache_listings(key: tuple, value):
+    with _cache_lock:
+        _listing_list_cache[key] = value
+
+
+def get_cached_user_listings(key: tuple):
+    with _cache_lock:
+        return _user_listings_cache.get(key)
+
+
+def cache_user_listings(key: tuple, value):
+    with _cache_lock:
+        _user_listings_cache[key] = value
+
+
+def invalidate_listing_caches(listing_id=None):
+    # Without an id every cached listing is dropped
+    with _cache_lock:
+        if listing_id is None:
+            _listing_cache.clear()
+        else:
+            _listing_cache.pop(str(listing_id).lower(), None)
+
+        _listing_list_cache.clear()
+        _user_listings_cache.clear()
@@ -0,0 +1,34 @@
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
+from passlib.context import CryptContext
+
+# The hash pool's spawned workers import this module to run these functions,
+# so it must stay free of imports that open connections or build engines
+
+PBKDF2_PREFIX = "$pbkdf2-sha256$"
+legacy_pwd_context = CryptContext(schemes=["pbkdf2_sha256"])
+password_hasher = PasswordHasher(
+    time_cost=3, memory_cost=65536, parallelism=1, hash_len=32, salt_len=16
+)
+
+
+def get_password_hash(password: str):
+    return password_hasher.hash(password)
+
+
+def verify_password(plain_password: str, password_hash: str):
+    # Accounts that predate Argon2id still hold passlib PBKDF2 hashes
+    if password_hash.startswith(PBKDF2_PREFIX):
+        return legacy_pwd_context.verify(plain_password, password_hash)
+
+    try:
+        return password_hasher.verify(password_hash, plain_password)
+    except VerifyMismatchError:
+        return False
+
+
+def password_needs_rehash(password_hash: str):
+    if password_hash.startswith(PBKDF2_PREFIX):
+        return True
+
+    return password_hasher.check_needs_rehash(password_hash)
@@ -0,0 +1,43 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+# Forking a worker that already runs threads and holds open connections can
+# copy locks in a held state, so workers start from a fresh interpreter
+_SPAWN_CONTEXT = multiprocessing.get_context("spawn")
+
+
+class ProcessPool:
+    """Starts a ProcessPoolExecutor the first time work is submitted
+
+    Nothing is started at import, so importing the module that owns the pool
+    has no side effects. Workers import the submitted function's module, which
+    must not start pools or do expensive work at import either.
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or os.cpu_count()
+        self._executor = None
+        self._lock = Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=_SPAWN_CONTEXT
+                )
+
+            return self._executor
+
+    def submit(self, func, *args):
+        return self.executor.submit(func, *args)
+
+    def shutdown(self):
+        # Called from the app's shutdown event, waits for running work
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown()
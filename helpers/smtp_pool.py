@@ -0,0 +1,76 @@
+import atexit
+import queue
+import smtplib
+import ssl
+from contextlib import contextmanager
+
+# Loading the CA bundle is expensive, so every connection shares a context
+_SSL_CTX = ssl.create_default_context()
+
+
+class SMTPPool:
+    """Keeps logged in SMTP_SSL connections around between sends
+
+    Connections are health checked with NOOP when they are taken from the
+    pool and replaced if the server has dropped them. A connection that
+    fails while in use is discarded instead of being returned.
+    """
+
+    def __init__(
+        self, host: str, port: int, username: str, password: str, size: int = 4
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self._connections = queue.Queue(maxsize=size)
+
+        atexit.register(self.close)
+
+    def _connect(self):
+        server = smtplib.SMTP_SSL(self.host, self.port, context=_SSL_CTX)
+        server.login(self.username, self.password)
+        return server
+
+    @staticmethod
+    def _is_alive(server: smtplib.SMTP_SSL):
+        try:
+            return server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _quit(server: smtplib.SMTP_SSL):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    @contextmanager
+    def acquire(self):
+        try:
+            server = self._connections.get_nowait()
+        except queue.Empty:
+            server = self._connect()
+        else:
+            if not self._is_alive(server):
+                server.close()
+                server = self._connect()
+
+        try:
+            yield server
+        except Exception:
+            server.close()
+            raise
+
+        try:
+            self._connections.put_nowait(server)
+        except queue.Full:
+            self._quit(server)
+
+    def close(self):
+        while True:
+            try:
+                self._quit(self._connections.get_nowait())
+            except queue.Empty:
+                return
@@ -1,4 +1,4 @@
-stop_words = [
+stop_words = {
     "i",
     "you'd",
     "than",
@@ -178,4 +178,4 @@ stop_words = [
     "that'll",
     "ll",
     "by",
-]
+}
@@ -1,24 +1,51 @@
+import hashlib
 import os
-from datetime import datetime
+import time
+from threading import Lock
 
+from cachetools import TLRUCache
+from cachetools import TTLCache
 from jose import jwt
 from jose.exceptions import ExpiredSignatureError
 from sqlalchemy.orm import Session
 
 from database.models import User
 
+_SECRET_KEY = os.getenv("SECRET_KEY")
+_ALGORITHM = os.getenv("ALGORITHM")
+
+
+def _claims_expiry(_token_hash, claims, now):
+    # Never keep decoded claims around longer than the token itself is valid
+    return min(now + 3600, claims.get("exp", now))
+
+
+_claims_cache = TLRUCache(maxsize=10000, ttu=_claims_expiry, timer=time.time)
+_user_cache = TTLCache(maxsize=10000, ttl=30)
+# get_current_user's result by token hash, and the token hashes cached for
+# each user so forget_current_user can drop all of them
+_current_user_cache = TTLCache(maxsize=10000, ttl=30)
+_current_user_tokens = TTLCache(maxsize=10000, ttl=30)
+_cache_lock = Lock()
+
 
 def decode_token(token: str):
-    if "Bearer" not in token:
+    if not token or not token.startswith("Bearer "):
         return False
 
-    decoded_token = token.split(" ")
+    decoded_token = token[7:]
+    token_hash = hashlib.sha256(decoded_token.encode()).digest()
+
+    with _cache_lock:
+        claims = _claims_cache.get(token_hash)
 
-    decoded_token = jwt.decode(
-        decoded_token[1], os.getenv("SECRET_KEY"), os.getenv("ALGORITHM")
-    )
+    if claims is None:
+        claims = jwt.decode(decoded_token, _SECRET_KEY, algorithms=[_ALGORITHM])
 
-    return decoded_token
+        with _cache_lock:
+            _claims_cache[token_hash] = claims
+
+    return claims
 
 
 def generate_id_from_token(token: str, user_id: str):
@@ -28,9 +55,10 @@ def generate_id_from_token(token: str, user_id: str):
     except ExpiredSignatureError:
         return False
 
-    has_token_expired = datetime.utcnow() > datetime.fromtimestamp(decoded_token["exp"])
+    if not decoded_token:
+        return False
 
-    return decoded_token["sub"] == str(user_id) and not has_token_expired
+    return decoded_token["sub"] == str(user_id)
 
 
 def verify_id_from_token(token: str, db: Session):
@@ -39,11 +67,59 @@ def verify_id_from_token(token: str, db: Session):
     except ExpiredSignatureError:
         return False
 
-    has_token_expired = datetime.utcnow() > datetime.fromtimestamp(decoded_token["exp"])
+    if not decoded_token:
+        return False
+
+    user_id = str(decoded_token["sub"]).lower()
+
+    with _cache_lock:
+        if user_id in _user_cache:
+            return True
 
-    if has_token_expired:
+    # Only users that exist are cached, so one created in the meantime is
+    # never turned away
+    if db.query(User.id).filter(User.id == user_id).first() is None:
         return False
 
-    saved_id = db.query(User).filter(User.id == decoded_token["sub"]).first()
+    with _cache_lock:
+        _user_cache[user_id] = True
+
+    return True
+
+
+def forget_user(user_id: str):
+    # Called once a user is deleted so their tokens stop being accepted
+    with _cache_lock:
+        _user_cache.pop(str(user_id).lower(), None)
+
+    forget_current_user(user_id)
+
+
+def get_cached_current_user(token_hash: bytes):
+    with _cache_lock:
+        cached = _current_user_cache.get(token_hash)
+
+    if cached and cached["exp"] > time.time():
+        return cached["user"]
+
+    return None
+
+
+def cache_current_user(token_hash: bytes, exp: int, user: dict):
+    user_id = str(user["id"]).lower()
+
+    with _cache_lock:
+        _current_user_cache[token_hash] = {"exp": exp, "user": user}
+        # Setting the entry again restarts its TTL, so it outlives every
+        # token hash it holds
+        _current_user_tokens[user_id] = _current_user_tokens.get(
+            user_id, frozenset()
+        ) | {token_hash}
+
 
-    return bool(saved_id)
+def forget_current_user(user_id):
+    # Called after a user is edited or deleted, so get_current_user reads
+    # the row again
+    with _cache_lock:
+        for token_hash in _current_user_tokens.pop(str(user_id).lower(), ()):
+            _current_user_cache.pop(token_hash, None)
@@ -1,8 +1,10 @@
-from uuid import UUID
+import re
+
+# \Z rather than $, which would also accept a trailing newline
+_UUID_RE = re.compile(
+    r"\A[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\Z", re.I
+)
 
 
 def uuid_validator(id: str):
-    try:
-        return bool(UUID(id))
-    except ValueError:
-        return False
+    return bool(_UUID_RE.match(id))
@@ -1,5 +1,15 @@
+from typing import Optional
+
 from fastapi import APIRouter
+from fastapi import Depends
+from fastapi import Header
+from fastapi import HTTPException
+from fastapi import status
+from sqlalchemy.orm import Session
+
+from database.db import AsyncSessionLocal
 from database.db import SessionLocal
+from helpers.token_verification import verify_id_from_token
 
 router = APIRouter()
 
@@ -11,3 +21,19 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# Shares the request's session with the route, as FastAPI resolves get_db
+# once per request
+def require_user(
+    authorization: Optional[str] = Header(None), db: Session = Depends(get_db)
+):
+    if not verify_id_from_token(authorization, db):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired"
+        )
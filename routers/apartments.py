@@ -1,23 +1,45 @@
-import json
+import hashlib
 import os
-import sys
+import re
 from typing import List
 from typing import Optional
 from uuid import UUID
 
-import requests
+import httpx
+import orjson
+from cachetools import TTLCache
 from fastapi import BackgroundTasks
 from fastapi import Depends
 from fastapi import HTTPException
+from fastapi import Request
+from fastapi import Response
 from fastapi import status
 from pydantic import BaseModel
 from sqlalchemy import func
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
 
-from . import get_db
+from . import get_async_db
 from . import router
 from database.models import Apartment
 from helpers.stop_words import stop_words
+from helpers.uuid_validator import uuid_validator
+
+http_client = httpx.AsyncClient(timeout=5)
+_pincode_cache = TTLCache(maxsize=10000, ttl=86400)
+_apartments_cache = TTLCache(maxsize=1, ttl=30)
+
+# Columns exposed by ApartmentBase; skips loading the name_token tsvector
+apartment_base_columns = load_only(
+    Apartment.id,
+    Apartment.name,
+    Apartment.address1,
+    Apartment.address2,
+    Apartment.city,
+    Apartment.state,
+    Apartment.pincode,
+)
 
 
 class ApartmentBase(BaseModel):
@@ -50,19 +72,66 @@ class ApartmentSearch(BaseModel):
         orm_mode = True
 
 
-def get_all_apartments(db: Session):
-    return db.query(Apartment).order_by(Apartment.name).all()
+async def get_all_apartments(db: AsyncSession):
+    result = await db.execute(
+        select(Apartment).options(apartment_base_columns).order_by(Apartment.name)
+    )
+    return result.scalars().all()
+
+
+async def get_cached_apartments(db: AsyncSession):
+    cached = _apartments_cache.get("apartments")
+
+    if cached is None:
+        apartments = [
+            ApartmentBase.from_orm(apartment).dict()
+            for apartment in await get_all_apartments(db)
+        ]
+        etag = f'"{hashlib.md5(orjson.dumps(apartments)).hexdigest()}"'
+        cached = _apartments_cache["apartments"] = (etag, apartments)
+
+    return cached
+
 
+async def get_specific_apartment(apartment: str, db: AsyncSession):
+    result = await db.execute(
+        select(Apartment)
+        .options(apartment_base_columns)
+        .where(Apartment.name == apartment)
+    )
+    return result.scalars().first()
 
-def get_specific_apartment(apartment: str, db: Session):
-    return db.query(Apartment).filter(Apartment.name == apartment).first()
 
+async def get_specific_apartment_from_id(apartment_id: str, db: AsyncSession):
+    if not uuid_validator(apartment_id):
+        return None
+
+    result = await db.execute(
+        select(Apartment)
+        .options(apartment_base_columns)
+        .where(Apartment.id == UUID(apartment_id))
+    )
+    return result.scalars().first()
+
+
+async def get_city_from_pincode(pincode: str):
+    city = _pincode_cache.get(pincode)
+
+    if city is None:
+        response = await http_client.get(
+            f"https://api.postalpincode.in/pincode/{pincode}"
+        )
+        res = response.json()
+
+        if res[0]["Status"] != "Success":
+            return "City not found"
 
-def get_specific_apartment_from_id(apartment_id: str, db: Session):
-    return db.query(Apartment).filter(Apartment.id == apartment_id).first()
+        city = _pincode_cache[pincode] = res[0]["PostOffice"][0]["District"]
 
+    return city
 
-def send_slack_message(apartment_name, pincode, city):
+
+async def send_slack_message(apartment_name, pincode, city):
     url = os.getenv("SLACK_WEBHOOK_URL")
     message = f"The apartment {apartment_name.upper()} located in {city} ({pincode}) was just added"
     title = "New Apartment Added :zap:"
@@ -83,9 +152,7 @@ def send_slack_message(apartment_name, pincode, city):
             }
         ],
     }
-    byte_length = str(sys.getsizeof(slack_data))
-    headers = {"Content-Type": "application/json", "Content-Length": byte_length}
-    response = requests.post(url, data=json.dumps(slack_data), headers=headers)
+    response = await http_client.post(url, json=slack_data)
     if response.status_code != 200:
         raise Exception(response.status_code, response.text)
 
@@ -93,59 +160,52 @@ def send_slack_message(apartment_name, pincode, city):
 @router.get(
     "/apartments", response_model=List[ApartmentBase], status_code=status.HTTP_200_OK
 )
-async def get_apartments(db: Session = Depends(get_db)):
+async def get_apartments(
+    request: Request, response: Response, db: AsyncSession = Depends(get_async_db)
+):
     """Returns a list of all the apartments
 
     Parameters
     ----------
-    db : Session
+    request : Request
+    response : Response
+    db : AsyncSession
 
     Returns
     -------
-    List : the list is based on the ApartmentBase model
-
-
-    Raises
-    ------
-    HTTPException
+    List : the list is based on the ApartmentBase model, or an empty 304
+    response when the client's If-None-Match matches the current ETag
 
     """
-    try:
-        return get_all_apartments(db)
-    except Exception:
-        raise HTTPException(
-            status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error fetching apartments"
+    etag, apartments = await get_cached_apartments(db)
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
         )
 
+    response.headers["ETag"] = etag
+    return apartments
+
 
 @router.get(
     "/apartment/{apartment}",
     response_model=ApartmentBase,
     status_code=status.HTTP_200_OK,
 )
-async def get_apartment(apartment: str, db: Session = Depends(get_db)):
+async def get_apartment(apartment: str, db: AsyncSession = Depends(get_async_db)):
     """Returns details of a specific apartment
 
     Parameters
     ----------
-    db : Session
+    db : AsyncSession
 
     Returns
     -------
     Dict : the dict is based on the ApartmentBase model
 
-
-    Raises
-    ------
-    HTTPException
-
     """
-    try:
-        return get_specific_apartment(apartment, db)
-    except Exception:
-        raise HTTPException(
-            status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error fetching apartments"
-        )
+    return await get_specific_apartment(apartment, db)
 
 
 @router.get(
@@ -153,67 +213,51 @@ async def get_apartment(apartment: str, db: Session = Depends(get_db)):
     response_model=ApartmentBase,
     status_code=status.HTTP_200_OK,
 )
-async def get_apartment_from_id(apartment_id: str, db: Session = Depends(get_db)):
+async def get_apartment_from_id(
+    apartment_id: str, db: AsyncSession = Depends(get_async_db)
+):
     """Returns details of a specific apartment based on the id
 
     Parameters
     ----------
-    db : Session
+    db : AsyncSession
 
     Returns
     -------
     Dict : the dict is based on the ApartmentBase model
 
-
-    Raises
-    ------
-    HTTPException
-
     """
-    try:
-        return get_specific_apartment_from_id(apartment_id, db)
-    except Exception:
-        raise HTTPException(
-            status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error fetching apartments"
-        )
+    return await get_specific_apartment_from_id(apartment_id, db)
 
 
 @router.post("/apartment", status_code=status.HTTP_201_CREATED)
-def create_new_apartment(
+async def create_new_apartment(
     apartment: ApartmentCreate,
     background_task: BackgroundTasks,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     try:
-        res = requests.get(
-            f"https://api.postalpincode.in/pincode/{apartment.pincode}"
-        ).json()
+        city = await get_city_from_pincode(apartment.pincode)
 
-        status = res[0]["Status"]
-
-        if status == "Success":
-            city = res[0]["PostOffice"][0]["District"]
-        else:
-            city = "City not found"
+        name = apartment.name.title()
 
         new_apartment = Apartment(
-            name=apartment.name.title(), city=city, pincode=apartment.pincode
+            name=name,
+            city=city,
+            pincode=apartment.pincode,
+            name_token=func.to_tsvector(name),
         )
 
         db.add(new_apartment)
-        db.commit()
-
-        db.query(Apartment).filter(Apartment.id == new_apartment.id).update(
-            {Apartment.name_token: func.to_tsvector(new_apartment.name)}
-        )
+        await db.commit()
 
-        db.commit()
+        _apartments_cache.clear()
 
         background_task.add_task(
             send_slack_message, apartment.name, apartment.pincode, city
         )
 
-        return {"id": new_apartment.id, "name": new_apartment.name}
+        return {"id": new_apartment.id, "name": name}
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -226,7 +270,9 @@ def create_new_apartment(
     response_model=List[ApartmentSearch],
     status_code=status.HTTP_200_OK,
 )
-def search_apartments(name: str, pincode: str, db: Session = Depends(get_db)):
+async def search_apartments(
+    name: str, pincode: str, db: AsyncSession = Depends(get_async_db)
+):
     try:
         if not name:
             return None
@@ -234,38 +280,29 @@ def search_apartments(name: str, pincode: str, db: Session = Depends(get_db)):
         search_string = name.split(" ")
 
         if len(search_string) > 1:
-            for word in search_string:
-                if word in stop_words:
-                    search_string.remove(word)
-
-        if len(search_string) == 1:
-            records = (
-                db.query(Apartment)
-                .filter(
-                    Apartment.name_token.match(f"{search_string[0][:3]}:*"),
-                    Apartment.pincode == pincode,
-                )
-                .all()
-            )
+            search_string = [word for word in search_string if word not in stop_words]
 
-        else:
-            records = (
-                db.query(Apartment)
-                .filter(
-                    Apartment.name_token.match(f"{search_string[1][:3]}:*"),
-                    Apartment.pincode == pincode,
-                )
-                .all()
-            )
+        if not search_string:
+            return []
+
+        # Strip tsquery operators so user input can't break the to_tsquery parse
+        word = search_string[0] if len(search_string) == 1 else search_string[1]
+        prefix = re.sub(r"\W", "", word)[:3]
 
-        if not records:
+        if not prefix:
             return []
 
-        for record in records:
-            return [
-                {"name": record.name, "city": record.city, "pincode": record.pincode}
-                for record in records
-            ]
+        result = await db.execute(
+            select(Apartment.name, Apartment.city, Apartment.pincode).where(
+                Apartment.name_token.match(f"{prefix}:*"),
+                Apartment.pincode == pincode,
+            )
+        )
+
+        return [
+            {"name": row.name, "city": row.city, "pincode": row.pincode}
+            for row in result
+        ]
 
     except Exception:
         raise HTTPException(
@@ -1,14 +1,14 @@
-import datetime as d
+import asyncio
+import hashlib
 import os
 import secrets
-import smtplib
-import ssl
-from collections import namedtuple
 from datetime import datetime
 from datetime import timedelta
 from email.message import EmailMessage
+from functools import lru_cache
 from typing import Optional
 
+from fastapi import BackgroundTasks
 from fastapi import Depends
 from fastapi import Header
 from fastapi import HTTPException
@@ -17,19 +17,46 @@ from fastapi.security import OAuth2PasswordBearer
 from fastapi.security import OAuth2PasswordRequestForm
 from jose import jwt
 from jose import JWTError
-from passlib.hash import pbkdf2_sha256
 from pydantic import BaseModel
-from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from . import get_db
 from . import router
 from database.models import User
+from helpers.passwords import get_password_hash
+from helpers.passwords import password_needs_rehash
+from helpers.passwords import verify_password
+from helpers.process_pool import ProcessPool
+from helpers.smtp_pool import SMTPPool
+from helpers.token_verification import cache_current_user
 from helpers.token_verification import generate_id_from_token
+from helpers.token_verification import get_cached_current_user
 from helpers.token_verification import verify_id_from_token
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth")
 
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = os.getenv("ALGORITHM")
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+
+OTP_RESEND_WINDOW = timedelta(minutes=5)
+OTP_VALIDITY = timedelta(minutes=10)
+
+# Hashing is CPU bound so it runs in worker processes, one per core, instead
+# of holding up the event loop or the shared threadpool
+_HASH_POOL = ProcessPool()
+
+smtp_pool = SMTPPool(
+    "smtp.gmail.com",
+    465,
+    "rentorsale.apartments@gmail.com",
+    os.getenv("SMTP_PASSWORD"),
+)
 
 # Schemas
 class Token(BaseModel):
@@ -37,10 +64,6 @@ class Token(BaseModel):
     token_type: str
 
 
-class TokenPayload(BaseModel):
-    id: Optional[str]
-
-
 class UserAuth(BaseModel):
     email: str
     password: str
@@ -65,28 +88,48 @@ class OtpEmail(BaseModel):
 # Helpers
 
 
-def get_password_hash(password: str):
-    return pbkdf2_sha256.hash(password)
+async def run_in_hash_pool(func, *args):
+    # func must be a module level function so it can be pickled, from a
+    # module like helpers.passwords that is cheap to import in a worker
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_HASH_POOL.executor, func, *args)
+
 
+def shutdown_hash_pool():
+    _HASH_POOL.shutdown()
 
-def verify_password(plain_password: str, password_hash: str):
-    return pbkdf2_sha256.verify(plain_password, password_hash)
+
+@lru_cache(maxsize=1)
+def get_dummy_password_hash():
+    # Computed at startup rather than when the module is imported
+    return get_password_hash("dummy-constant-string")
 
 
 def find_user_by_email(email: str, db: Session = Depends(get_db)):
-    return db.query(User).filter(User.email == email).first()
+    return db.execute(
+        select(User.id, User.password).where(func.lower(User.email) == email)
+    ).first()
 
 
-def authenticate_user(email: str, password: str, db: Session = Depends(get_db)):
+async def authenticate_user(email: str, password: str, db: Session = Depends(get_db)):
     email = email.lower()
-    user = find_user_by_email(email, db)
+    user = await run_in_threadpool(find_user_by_email, email, db)
+
+    # Verify against a dummy hash for unknown emails so both failures take
+    # the same time and return the same error
+    password_hash = user.password if user else get_dummy_password_hash()
 
-    if not user:
+    verified = await run_in_hash_pool(verify_password, password, password_hash)
+
+    if not verified or not user:
         raise HTTPException(
-            status_code=401, detail="Sorry! We cannot find that email address"
+            status_code=401, detail="Sorry! That email or password is incorrect"
         )
-    if not verify_password(password, user.password):
-        raise HTTPException(status_code=401, detail="Sorry! That password is incorrect")
+
+    if password_needs_rehash(user.password):
+        new_hash = await run_in_hash_pool(get_password_hash, password)
+        await run_in_threadpool(fp_change_password, user.id, new_hash, db)
+
     return user
 
 
@@ -94,14 +137,11 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     # sourcery skip: inline-immediately-returned-variable
     to_encode = data.copy()
 
-    expire = datetime.utcnow() + timedelta(
-        minutes=int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
-    )
+    now = datetime.utcnow()
+    expire = now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
 
-    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
-    encoded_jwt = jwt.encode(
-        to_encode, os.getenv("SECRET_KEY"), algorithm=os.getenv("ALGORITHM")
-    )
+    to_encode.update({"exp": expire, "iat": now})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
@@ -121,10 +161,16 @@ def get_current_user(
             headers={"WWWW-Authenticate": "Bearer"},
         )
 
+    token_hash = hashlib.sha256(token.encode()).digest()
+
+    cached = get_cached_current_user(token_hash)
+
+    if cached is not None:
+        return cached
+
     try:
-        payload = jwt.decode(token, os.getenv("SECRET_KEY"), os.getenv("ALGORITHM"))
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         sub = payload.get("sub")
-        token_data = TokenPayload(id=sub)
         if sub is None:
             raise credentials_exception
 
@@ -132,53 +178,71 @@ def get_current_user(
         raise credentials_exception
 
     user = (
-        db.query(User.id, User.name, User.email, User.is_active, User.verify_user)
-        .filter(and_(User.id == token_data.id))
+        db.execute(
+            select(
+                User.id, User.name, User.email, User.is_active, User.verify_user
+            ).where(User.id == sub)
+        )
+        .mappings()
         .first()
     )
 
     if user is None:
         raise credentials_exception
 
-    CurrentUser = namedtuple(
-        "CurrentUser",
-        "id name email is_active verify_user",
-    )
-
-    user_dict = CurrentUser._make(user)._asdict()
+    # Only active users are cached, so a cache hit above needs no check
+    if not user["is_active"]:
+        raise HTTPException(status_code=400, detail="Inactive user")
 
-    return {
-        "id": user_dict["id"],
-        "name": user_dict["name"],
-        "email": user_dict["email"],
-        "is_active": user_dict["is_active"],
-        "verify_user": user_dict["verify_user"],
-    }
+    current_user = dict(user)
 
+    cache_current_user(token_hash, payload["exp"], current_user)
 
-def get_current_active_user(current_user: UserAuth = Depends(get_current_user)):
-    if not current_user["is_active"]:
-        raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
 
 def fp_get_email(email: str, db: Session):
     return (
         db.query(User.id, User.email, User.otp_generation_timestamp)
-        .filter(User.email == email.lower())
+        .filter(func.lower(User.email) == email.lower())
         .first()
     )
 
 
 def fp_generate_otp(id: str, otp: str, db: Session):
     db.query(User).filter(User.id == id).update(
-        {User.otp: otp, User.otp_generation_timestamp: datetime.now()}
+        {User.otp: otp, User.otp_generation_timestamp: datetime.utcnow()}
     )
     db.commit()
 
 
-def fp_validate_otp(otp: str, db: Session):
-    return db.query(User).filter(User.otp == otp).first()
+def valid_otp_conditions(id: str, otp: str):
+    return (
+        User.id == id,
+        User.otp == otp,
+        User.otp_generation_timestamp > datetime.utcnow() - OTP_VALIDITY,
+    )
+
+
+def fp_check_otp(id: str, otp: str, db: Session):
+    # Cheap check so a wrong or expired otp is turned away before hashing
+    return db.execute(select(User.id).where(*valid_otp_conditions(id, otp))).first()
+
+
+def fp_reset_password(id: str, otp: str, password: str, db: Session):
+    # Checks the otp, its age and sets the password in a single statement, in
+    # case the otp was used or replaced after fp_check_otp
+    result = db.execute(
+        update(User)
+        .where(*valid_otp_conditions(id, otp))
+        .values(password=password)
+        .returning(User.id)
+        .execution_options(synchronize_session=False)
+    )
+    updated = result.first()
+    db.commit()
+
+    return updated
 
 
 def fp_change_password(id: str, password: str, db: Session):
@@ -186,21 +250,35 @@ def fp_change_password(id: str, password: str, db: Session):
     db.commit()
 
 
+def send_otp_email(email: str, otp: str):
+    msg = EmailMessage()
+
+    msg["From"] = smtp_pool.username
+    msg["To"] = email
+    msg["Subject"] = "OTP to reset your password"
+    msg.set_content(
+        f"Otp to reset your rentorsale.apartments password - {otp}.\n\nThe otp is valid for 10 minutes only."
+    )
+
+    with smtp_pool.acquire() as server:
+        server.send_message(msg)
+
+
 # End points
 @router.post("/auth", response_model=Token)
-def login(
+async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: Session = Depends(get_db),
 ):
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     id = str(user.id)
     access_token = create_access_token(data={"sub": id})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @router.get("/auth/current_user", status_code=status.HTTP_200_OK)
-def get_current_user(
-    current_user: UserAuth = Depends(get_current_active_user),
+def read_current_user(
+    current_user: UserAuth = Depends(get_current_user),
     authorization: str = Header(None),
 ):
     if not generate_id_from_token(authorization, current_user["id"]):
@@ -234,7 +312,7 @@ def verify_email_address(email: str, db: Session = Depends(get_db)):
 
     if (
         record.otp_generation_timestamp
-        and datetime.now() < record.otp_generation_timestamp + d.timedelta(minutes=5)
+        and datetime.utcnow() < record.otp_generation_timestamp + OTP_RESEND_WINDOW
     ):
         raise HTTPException(
             status_code=status.HTTP_425_TOO_EARLY,
@@ -246,12 +324,12 @@ def verify_email_address(email: str, db: Session = Depends(get_db)):
 
 @router.put("/otp/{id}", status_code=status.HTTP_201_CREATED)
 def generate_otp(id: str, db: Session = Depends(get_db)):
-    try:
-        otp = secrets.token_hex(3).upper()
+    otp = f"{secrets.randbits(24):06X}"
 
+    try:
         fp_generate_otp(id, otp, db)
         return {"message": "Otp generated", "token": otp}
-    except Exception:
+    except SQLAlchemyError:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Could not generate the otp",
@@ -259,52 +337,35 @@ def generate_otp(id: str, db: Session = Depends(get_db)):
 
 
 @router.post("/email/send_otp", status_code=status.HTTP_201_CREATED)
-def send_otp_to_user(otp: OtpEmail, db: Session = Depends(get_db)):
-    record = db.query(User).filter(User.email == otp.email).first()
+def send_otp_to_user(
+    otp: OtpEmail, background_task: BackgroundTasks, db: Session = Depends(get_db)
+):
+    record = db.execute(
+        select(User.email, User.otp).where(func.lower(User.email) == otp.email.lower())
+    ).first()
 
     if not record:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="That email does not exist"
         )
 
-    msg = EmailMessage()
-
-    port = 465  # For SSL
-    smtp_server = "smtp.gmail.com"
-    password = os.getenv("SMTP_PASSWORD")
-
-    msg["From"] = "rentorsale.apartments@gmail.com"
-    msg["To"] = record.email
-    msg["Subject"] = "OTP to reset your password"
-    msg.set_content(
-        f"Otp to reset your rentorsale.apartments password - {record.otp}.\n\nThe otp is valid for 10 minutes only."
-    )
-
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(smtp_server, port, context=context) as server:
-        server.login(msg["From"], password)
-        server.send_message(msg)
-        server.quit()
+    background_task.add_task(send_otp_email, record.email, record.otp)
 
     return {"message": "Email sent"}
 
 
 @router.put("/user/password/{id}", status_code=status.HTTP_201_CREATED)
-def change_password(id: str, fp: ForgotPassword, db: Session = Depends(get_db)):
-    record = db.query(User).filter(User.id == id).first()
-
-    if datetime.now() > record.otp_generation_timestamp + d.timedelta(minutes=10):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Otp has expired"
-        )
+async def change_password(id: str, fp: ForgotPassword, db: Session = Depends(get_db)):
+    invalid_otp = HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid or expired otp"
+    )
 
-    if not fp_validate_otp(fp.otp, db):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect otp"
-        )
+    if not await run_in_threadpool(fp_check_otp, id, fp.otp, db):
+        raise invalid_otp
 
-    password = pbkdf2_sha256.hash(fp.password)
+    password = await run_in_hash_pool(get_password_hash, fp.password)
 
-    fp_change_password(id, password, db)
+    if not await run_in_threadpool(fp_reset_password, id, fp.otp, password, db):
+        raise invalid_otp
 
     return {"message": "Password changed successfully"}
@@ -1,37 +1,82 @@
+import hashlib
 import io
-import json
-import os
 import secrets
+import time
+from collections import defaultdict
 from datetime import date
-from datetime import timedelta
-from decimal import Decimal
-from math import trunc
+from functools import lru_cache
 from typing import List
 from typing import Optional
 from uuid import UUID
 
+import orjson
+import requests
+from babel import Locale
 from babel.numbers import format_decimal
+from fastapi import BackgroundTasks
 from fastapi import Depends
 from fastapi import Form
-from fastapi import Header
 from fastapi import HTTPException
+from fastapi import Query
+from fastapi import Request
+from fastapi import Response
 from fastapi import status
 from fastapi import UploadFile
 from PIL import Image
-from PIL import UnidentifiedImageError
 from pydantic import BaseModel
+from sqlalchemy import BigInteger
+from sqlalchemy import cast
+from sqlalchemy import func
+from sqlalchemy import literal_column
+from sqlalchemy import select
+from sqlalchemy import tuple_
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 
 from . import get_db
+from . import require_user
 from . import router
+from database.db import SessionLocal
 from database.models import Apartment
 from database.models import Listing
 from database.models import ListingImage
 from database.models import User
+from helpers.image_encoding import DECODED_FORMATS
+from helpers.image_encoding import encode_image
+from helpers.image_encoding import image_format
+from helpers.image_encoding import MAX_UPLOAD_PIXELS
+from helpers.imagekit_init import delete_imagekit_files
+from helpers.imagekit_init import IMAGEKIT_POOL
 from helpers.imagekit_init import initialize_imagekit
-from helpers.token_verification import verify_id_from_token
+from helpers.listing_cache import cache_listing
+from helpers.listing_cache import cache_listings
+from helpers.listing_cache import get_cached_listing
+from helpers.listing_cache import get_cached_listings
+from helpers.listing_cache import invalidate_listing_caches
+from helpers.process_pool import ProcessPool
 from helpers.uuid_validator import uuid_validator
 
+# Every upload is held in memory until its background task ends
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+MAX_REQUEST_UPLOAD_BYTES = 40 * 1024 * 1024
+
+LISTINGS_CACHE_CONTROL = "public, max-age=30"
+
+LISTINGS_PAGE_SIZE = 20
+MAX_LISTINGS_PAGE_SIZE = 100
+
+EN_IN_LOCALE = Locale.parse("en_IN")
+
+# Image resizing is CPU bound, one process per core
+_ENCODE_POOL = ProcessPool()
+
+UPLOAD_ATTEMPTS = 3
+UPLOAD_RETRY_DELAY = 0.5
+
+
+class ImageUploadError(Exception):
+    """ImageKit still reported an error after the last upload attempt"""
+
 
 class ListingBase(BaseModel):
     id: Optional[UUID]
@@ -57,11 +102,92 @@ class ListingBase(BaseModel):
         orm_mode = True
 
 
-def get_all_listings(db: Session):
-    return db.query(Listing).order_by(Listing.date_created.desc()).all()
+def get_all_listings(db: Session, limit: int, offset: int = 0, after: tuple = None):
+    # Only the columns ListingBase serialises, with the apartment's name
+    # rather than the whole related row. date_created and id order the rows
+    # and make up the cursor for the next page
+    query = (
+        select(
+            Listing.id,
+            Listing.title,
+            Listing.listing_type,
+            Listing.total_area,
+            Listing.description,
+            Listing.mobile_number,
+            Listing.bedrooms,
+            Listing.bathrooms,
+            Listing.floors,
+            Listing.whatsapp_number,
+            Listing.parking_available,
+            Listing.brokers_excuse,
+            Listing.available_from,
+            Listing.user_id,
+            Listing.apartment_id,
+            Listing.date_created,
+            Apartment.name.label("apartment"),
+        )
+        .outerjoin(Apartment, Listing.apartment_id == Apartment.id)
+        .order_by(Listing.date_created.desc(), Listing.id.desc())
+        .limit(limit)
+        .offset(offset)
+    )
+
+    # Keyset pagination, the index on (date_created, id) seeks straight to
+    # the page instead of reading and discarding the rows before it
+    if after:
+        query = query.where(
+            tuple_(Listing.date_created, Listing.id)
+            < tuple_(*after, types=(Listing.date_created.type, Listing.id.type))
+        )
+
+    return db.execute(query).mappings().all()
+
+
+def encode_listing_cursor(listing):
+    return f"{listing['date_created'].isoformat()}_{listing['id']}"
+
+
+def decode_listing_cursor(cursor: str):
+    try:
+        date_created, listing_id = cursor.split("_")
+        return date.fromisoformat(date_created), UUID(listing_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+
+def whole_amount(column):
+    # Truncated and cast to bigint in Postgres so the driver returns an int
+    return cast(func.trunc(column), BigInteger)
+
+
+def aggregate_images():
+    # Builds the image dicts of a listing inside Postgres
+    return func.json_agg(
+        func.json_build_object(
+            "image_url",
+            ListingImage.image_path,
+            "image_thumbnail",
+            ListingImage.thumbnail_url,
+            "height",
+            ListingImage.height,
+            "width",
+            ListingImage.width,
+            "ik_file_id",
+            ListingImage.imagekit_file_id,
+        )
+    )
 
 
 def get_listing(listing_id: UUID, db: Session):
+    # The images come back in the same round trip as a correlated subquery
+    images = (
+        select(func.coalesce(aggregate_images(), literal_column("'[]'::json")))
+        .where(ListingImage.listing_id == Listing.id)
+        .scalar_subquery()
+    )
+
     return (
         db.query(
             Listing.title,
@@ -80,10 +206,10 @@ def get_listing(listing_id: UUID, db: Session):
             Listing.user_id,
             Listing.apartment_id,
             Listing.date_created,
-            Listing.rent_amount,
-            Listing.maintenance_amount,
-            Listing.deposit_amount,
-            Listing.sale_amount,
+            whole_amount(Listing.rent_amount).label("rent_amount"),
+            whole_amount(Listing.maintenance_amount).label("maintenance_amount"),
+            whole_amount(Listing.deposit_amount).label("deposit_amount"),
+            whole_amount(Listing.sale_amount).label("sale_amount"),
             Listing.sale_amount_value,
             Listing.maintenance_included_in_rent,
             Listing.rent_amount_negotiable,
@@ -96,6 +222,7 @@ def get_listing(listing_id: UUID, db: Session):
             Listing.prefers_text,
             Apartment.name.label("apartment"),
             User.name.label("user_name"),
+            images.label("images"),
         )
         .join(Apartment, Listing.apartment_id == Apartment.id)
         .join(User, Listing.user_id == User.id)
@@ -104,81 +231,167 @@ def get_listing(listing_id: UUID, db: Session):
     )
 
 
-def get_listing_images(listing_id, db):
+def get_images_for_listings(listing_ids: List[UUID], db: Session):
+    # One IN query for every listing on the page instead of one per listing
+    image_map = defaultdict(list)
+
+    if not listing_ids:
+        return image_map
+
     images = (
         db.query(
+            ListingImage.listing_id,
             ListingImage.image_path,
             ListingImage.thumbnail_url,
             ListingImage.height,
             ListingImage.width,
             ListingImage.imagekit_file_id,
         )
-        .filter(ListingImage.listing_id == str(listing_id))
+        .filter(ListingImage.listing_id.in_(listing_ids))
         .all()
     )
 
-    image_list = []
-    image_obj = {}
-
-    if len(images) > 0:
-        for image in images:
-            image_obj["image_url"] = image[0]
-            image_obj["image_thumbnail"] = image[1]
-            image_obj["height"] = image[2]
-            image_obj["width"] = image[3]
-            image_obj["ik_file_id"] = image[4]
+    for image in images:
+        image_map[image.listing_id].append(
+            {
+                "image_url": image.image_path,
+                "image_thumbnail": image.thumbnail_url,
+                "height": image.height,
+                "width": image.width,
+                "ik_file_id": image.imagekit_file_id,
+            }
+        )
 
-            image_list.append(image_obj.copy())
+    return image_map
 
-    return image_list
 
+def get_listing_summaries_for_apartment(apartment: str, db: Session):
+    # Listings without images produce a single all NULL row from the outer
+    # join, so those are filtered out of the aggregate
+    images = func.coalesce(
+        aggregate_images().filter(ListingImage.id.isnot(None)),
+        literal_column("'[]'::json"),
+    )
 
-def get_listings_for_apartment(apartment: str, db: Session):
     return (
-        db.query(Listing)
+        db.query(
+            Listing.id,
+            Listing.title,
+            Listing.listing_type,
+            Listing.description,
+            Listing.bedrooms,
+            Listing.date_created,
+            Listing.rent_amount,
+            Listing.sale_amount,
+            Listing.sale_amount_value,
+            images.label("images"),
+        )
         .join(Apartment, Listing.apartment_id == Apartment.id)
+        .outerjoin(ListingImage, ListingImage.listing_id == Listing.id)
         .filter(Apartment.name == apartment)
+        .group_by(Listing.id)
         .all()
     )
 
 
-def filter_listings(type_of_listing, bedrooms, apartment, db: Session):
+def parse_bedrooms_filter(bedrooms: str):
+    """
+    Splits a bedrooms filter into an exact count and a lower bound
+
+    "3+" matches more than three bedrooms. An unencoded "+" in a query string
+    decodes to a space, so "3 " is read as "3+" too, clients should still send
+    it as "3%2B"
+
+    Parameters
+    ----------
+    bedrooms : str
+
+    Returns
+    -------
+    Tuple of the exact bedroom count and the minimum bedroom count, one of
+    them is None
+
+    Raises
+    ------
+    ValueError
+        When the filter is not a number, optionally followed by "+"
+    """
+    value = bedrooms.rstrip()
+
+    if value.endswith("+") or len(value) < len(bedrooms):
+        return None, int(value[:-1] if value.endswith("+") else value) + 1
+
+    return int(value), None
+
+
+def filter_listings(
+    type_of_listing, bedrooms, apartment, db: Session, min_bedrooms=None
+):
+    # Only the columns of the summary get_filtered_listings returns
     filter = db.query(
         Listing.id,
         Listing.title,
         Listing.listing_type,
-        Listing.total_area,
         Listing.description,
-        Listing.mobile_number,
         Listing.bedrooms,
-        Listing.bathrooms,
-        Listing.floors,
-        Listing.whatsapp_number,
-        Listing.parking_available,
-        Listing.brokers_excuse,
-        Listing.available_from,
-        Listing.user_id,
-        Listing.apartment_id,
         Listing.date_created,
         Listing.rent_amount,
         Listing.sale_amount,
-        Apartment.name.label("apartment"),
+        Listing.sale_amount_value,
     ).join(Apartment, Listing.apartment_id == Apartment.id)
 
     if type_of_listing:
         filter = filter.filter(Listing.listing_type == type_of_listing.lower())
 
-    if bedrooms:
-        if bedrooms == "3+":
-            filter = filter.filter(Listing.bedrooms > 3)
-        else:
-            filter = filter.filter(Listing.bedrooms == int(bedrooms))
+    if bedrooms is not None:
+        filter = filter.filter(Listing.bedrooms == bedrooms)
+
+    if min_bedrooms is not None:
+        filter = filter.filter(Listing.bedrooms >= min_bedrooms)
 
     filter = filter.filter(Apartment.name == apartment)
 
     return filter.all()
 
 
+def build_listing_summary(record, images: List, today: date):
+    # The shape the apartment pages list listings in
+    return {
+        "id": record.id,
+        "title": record.title,
+        "listing_type": record.listing_type,
+        "description": record.description,
+        "bedrooms": record.bedrooms,
+        "date_created": date_formatter(record.date_created, today),
+        "images": images,
+        "rent": record.rent_amount,
+        "sale": record.sale_amount,
+        "sale_amount_value": record.sale_amount_value,
+    }
+
+
+def get_filtered_listings(
+    type_of_listing, bedrooms, apartment, db: Session, min_bedrooms=None
+):
+    # Both branches return the same summary, without filters the images come
+    # aggregated in the listings query itself
+    if not type_of_listing and bedrooms is None and min_bedrooms is None:
+        records = get_listing_summaries_for_apartment(apartment, db)
+        image_map = {record.id: record.images for record in records}
+    else:
+        records = filter_listings(
+            type_of_listing, bedrooms, apartment, db, min_bedrooms
+        )
+        image_map = get_images_for_listings([record.id for record in records], db)
+
+    today = date.today()
+
+    return [
+        build_listing_summary(record, image_map.get(record.id, []), today)
+        for record in records
+    ]
+
+
 def create_new_listing(listing: ListingBase, db: Session):
     new_listing = Listing(
         title=listing.title,
@@ -193,8 +406,8 @@ def create_new_listing(listing: ListingBase, db: Session):
         parking_available=listing.parking_available,
         brokers_excuse=listing.brokers_excuse,
         available_from=listing.available_from,
-        user_id=str(listing.user_id),
-        apartment_id=str(listing.apartment_id),
+        user_id=listing.user_id,
+        apartment_id=listing.apartment_id,
     )
 
     db.add(new_listing)
@@ -203,17 +416,16 @@ def create_new_listing(listing: ListingBase, db: Session):
     return new_listing.id
 
 
-def create_image_record(
+def build_image_record(
     listing_id: UUID,
     image_path: str,
     height: int,
     width: int,
     thumbnailUrl: str,
     ik_fileId: str,
-    db: Session,
 ):
-    new_image = ListingImage(
-        listing_id=str(listing_id),
+    return ListingImage(
+        listing_id=listing_id,
         image_path=image_path,
         height=height,
         width=width,
@@ -221,38 +433,85 @@ def create_image_record(
         thumbnail_url=thumbnailUrl,
     )
 
-    db.add(new_image)
-    db.commit()
-
 
 def format_amount(amount):
-    if Decimal(amount) % 1 == 0:
-        return format_decimal(int(amount), locale="en_IN")
+    # int() already truncates, so whole and fractional amounts format alike
+    return format_decimal(int(amount), locale=EN_IN_LOCALE)
 
-    return format_decimal(trunc(int(amount)), locale="en_IN")
 
+def read_uploaded_images(images: List[UploadFile]):
+    # The upload itself runs after the response is sent, so the files are
+    # read and their format checked while the request is still open
+    uploads = []
 
-def upload_image_to_imagekit(listing_id: str, images: List, db: Session):
-    imagekit = initialize_imagekit()
+    total_bytes = 0
+
+    unsupported = HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="The format of the uploaded image is currently unsupported.\nPlease upload a different image.",
+    )
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail="The uploaded images are too large.\nPlease upload smaller images.",
+    )
 
     for image in images:
-        file_name, file_ext = os.path.splitext(image.filename)
+        # Extensions that cannot be saved back are refused before any decoding
+        image_fmt = image_format(image.filename)
 
-        file_ext = file_ext.lower()
+        if image_fmt is None:
+            raise unsupported
 
-        if file_ext == ".jpg":
-            file_ext = ".jpeg"
+        # One byte past the limit is enough to tell the file is too large
+        data = image.file.read(MAX_UPLOAD_BYTES + 1)
+        total_bytes += len(data)
+
+        if len(data) > MAX_UPLOAD_BYTES or total_bytes > MAX_REQUEST_UPLOAD_BYTES:
+            raise too_large
 
         try:
-            optimized_image = Image.open(image.file)
-            # optimized_image = fix_image_orientation(optimized_image)
+            with Image.open(io.BytesIO(data)) as opened_image:
+                if opened_image.width * opened_image.height > MAX_UPLOAD_PIXELS:
+                    raise too_large
+
+                # The extension picks the format the file is saved back in,
+                # so it has to match what the file actually is
+                decoded_fmt = opened_image.format
+
+                if DECODED_FORMATS.get(decoded_fmt, decoded_fmt) != image_fmt:
+                    raise unsupported
+
+                # Checks the file's structure without decoding the pixels
+                opened_image.verify()
+        except Image.DecompressionBombError:
+            raise too_large
+        except (SyntaxError, OSError, ValueError):
+            raise unsupported
+
+        uploads.append((image.filename, data))
+
+    return uploads
+
+
+def shutdown_encode_pool():
+    _ENCODE_POOL.shutdown()
+
+
+def upload_single_image(imagekit, listing_id: str, upload: tuple):
+    # Resizing is CPU bound, so it runs in a worker process while this
+    # thread waits, leaving the web worker's GIL to the requests it serves
+    in_mem_file = io.BytesIO(_ENCODE_POOL.submit(encode_image, *upload).result())
 
-            in_mem_file = io.BytesIO()
-            optimized_image.save(in_mem_file, format=file_ext[1:], optimized=True)
-            in_mem_file.seek(0)
+    random_file_name = secrets.token_hex(8)
 
-            random_file_name = secrets.token_hex(8)
+    # The SDK hides the status code and reports failures in "error", so
+    # throttling and server errors are retried with a doubling delay
+    delay = UPLOAD_RETRY_DELAY
 
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        in_mem_file.seek(0)
+
+        try:
             uploaded_image = imagekit.upload_file(
                 file=in_mem_file,
                 file_name=random_file_name,
@@ -262,22 +521,82 @@ def upload_image_to_imagekit(listing_id: str, images: List, db: Session):
                     "use_unique_file_name": False,
                 },
             )
+        except requests.RequestException:
+            if attempt == UPLOAD_ATTEMPTS:
+                raise
+        else:
+            if not uploaded_image["error"]:
+                return uploaded_image
 
-            create_image_record(
-                listing_id,
-                uploaded_image["response"]["url"],
-                uploaded_image["response"]["height"],
-                uploaded_image["response"]["width"],
-                uploaded_image["response"]["thumbnailUrl"],
-                uploaded_image["response"]["fileId"],
-                db,
-            )
-        except UnidentifiedImageError:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="The format of the uploaded image is currently unsupported.\nPlease upload a different image.",
+            if attempt == UPLOAD_ATTEMPTS:
+                raise ImageUploadError(
+                    f"Upload for listing {listing_id} failed: {uploaded_image['error']}"
+                )
+
+        time.sleep(delay)
+        delay *= 2
+
+
+def upload_image_to_imagekit(listing_id: str, uploads: List):
+    imagekit = initialize_imagekit()
+    # Runs as a background task, after the request's session is closed
+    db = SessionLocal()
+
+    uploaded_images = []
+
+    try:
+        # The uploads are independent so they go out side by side; the
+        # session is only ever touched from this thread
+        futures = [
+            IMAGEKIT_POOL.submit(upload_single_image, imagekit, listing_id, upload)
+            for upload in uploads
+        ]
+        failure = None
+
+        # Every upload is waited on, so a failure still leaves the complete
+        # list of files that made it to ImageKit
+        for future in futures:
+            try:
+                uploaded_images.append(future.result())
+            except Exception as exc:
+                failure = failure or exc
+
+        if failure is not None:
+            raise failure
+
+        db.add_all(
+            [
+                build_image_record(
+                    listing_id,
+                    uploaded_image["response"]["url"],
+                    uploaded_image["response"]["height"],
+                    uploaded_image["response"]["width"],
+                    uploaded_image["response"]["thumbnailUrl"],
+                    uploaded_image["response"]["fileId"],
+                )
+                for uploaded_image in uploaded_images
+            ]
+        )
+        # One transaction for every image of the listing
+        db.commit()
+
+        invalidate_listing_caches(listing_id)
+    except Exception:
+        db.rollback()
+
+        # Nothing refers to the uploaded files without their rows
+        if uploaded_images:
+            delete_imagekit_files(
+                [
+                    uploaded_image["response"]["fileId"]
+                    for uploaded_image in uploaded_images
+                ]
             )
 
+        raise
+    finally:
+        db.close()
+
 
 def delete_selected_listing(listing_id: str, db: Session):
     listing_images = (
@@ -287,55 +606,111 @@ def delete_selected_listing(listing_id: str, db: Session):
     )
 
     if len(listing_images) > 0:
-        imagekit = initialize_imagekit()
-
-        for image in listing_images:
-            imagekit.delete_file(image)
+        delete_imagekit_files([image.imagekit_file_id for image in listing_images])
 
         db.query(ListingImage).filter(ListingImage.listing_id == listing_id).delete()
-        db.commit()
 
+    # The images and the listing go in the same transaction
     db.query(Listing).filter(Listing.id == listing_id).delete()
     db.commit()
 
+    invalidate_listing_caches(listing_id)
+
+
+def conditional_response(
+    request: Request, content: List, headers: Optional[dict] = None
+):
+    # Serialised once for both the ETag and the body. Clients and proxies may
+    # reuse the list for a short while and then revalidate it with
+    # If-None-Match instead of downloading it again
+    body = orjson.dumps(content)
+    etag = f'"{hashlib.md5(body).hexdigest()}"'
+    headers = {**(headers or {}), "ETag": etag, "Cache-Control": LISTINGS_CACHE_CONTROL}
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
-def date_formatter(date_created):
-    days = int((date.today() - date_created) / timedelta(days=1))
+    return Response(content=body, media_type="application/json", headers=headers)
 
+
+@lru_cache(maxsize=512)
+def format_days_ago(days: int):
     if days == 0:
         return "today"
     elif days == 1:
         return "yesterday"
     elif days > 1 and days <= 30:
         return f"{days}d ago"
-    elif days > 30:
-        return "over a month ago"
     elif days > 365:
         return "over a year ago"
+    elif days > 30:
+        return "over a month ago"
+
+
+def date_formatter(date_created, today: Optional[date] = None):
+    return format_days_ago(((today or date.today()) - date_created).days)
 
 
 @router.get(
     "/listings", response_model=List[ListingBase], status_code=status.HTTP_200_OK
 )
-def get_listings(db: Session = Depends(get_db)):
+def get_listings(
+    request: Request,
+    limit: int = Query(LISTINGS_PAGE_SIZE, ge=1, le=MAX_LISTINGS_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
     """
     Return all the listings in the database
 
     Parameters
     ----------
+    request : Request
+    limit : int, optional
+        Maximum number of listings to return, 20 by default and at most 100
+    offset : int, optional
+        Number of listings to skip
+    cursor : str, optional
+        X-Next-Cursor of the previous page, returns the listings after it
     db : Session
 
     Returns
     -------
-    List : the list is based on the ListingBase model
+    List : the list is based on the ListingBase model, or an empty 304
+    response when the client's If-None-Match matches the current ETag. The
+    X-Next-Cursor header carries the cursor for the next page, and is empty
+    on the last one
 
     Raises
     ------
     HTTPException
 
     """
+    after = decode_listing_cursor(cursor) if cursor else None
+
     try:
-        return get_all_listings(db)
+        cache_key = ("all", limit, offset, cursor)
+
+        cached = get_cached_listings(cache_key)
+
+        if cached is None:
+            rows = get_all_listings(db, limit, offset, after)
+
+            # Validated here once; the Response returned below skips the
+            # response_model pass, which is kept for the OpenAPI schema
+            listings = [ListingBase(**listing).dict() for listing in rows]
+            next_cursor = (
+                encode_listing_cursor(rows[-1]) if len(rows) == limit else None
+            )
+
+            cache_listings(cache_key, (listings, next_cursor))
+        else:
+            listings, next_cursor = cached
+
+        return conditional_response(
+            request, listings, {"X-Next-Cursor": next_cursor or ""}
+        )
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -365,14 +740,19 @@ def get_single_listing(listing_id: str, db: Session = Depends(get_db)):
     if not uuid_validator(listing_id):
         return []
 
+    cache_key = listing_id.lower()
+
+    cached = get_cached_listing(cache_key)
+
+    if cached is not None:
+        return cached
+
     listing = get_listing(listing_id, db)
 
     if not listing:
         return []
 
-    images = get_listing_images(listing_id, db)
-
-    return {
+    result = {
         "title": listing.title,
         "listing_type": listing.listing_type,
         "total_area": listing.total_area,
@@ -391,11 +771,11 @@ def get_single_listing(listing_id: str, db: Session = Depends(get_db)):
         "apartment": listing.apartment,
         "user_name": listing.user_name,
         "date_created": listing.date_created,
-        "images": images,
-        "rent": int(listing.rent_amount),
-        "maintenance": int(listing.maintenance_amount),
-        "deposit": int(listing.deposit_amount),
-        "sale": int(listing.sale_amount),
+        "images": listing.images,
+        "rent": listing.rent_amount,
+        "maintenance": listing.maintenance_amount,
+        "deposit": listing.deposit_amount,
+        "sale": listing.sale_amount,
         "sale_amount_unit": listing.sale_amount_value,
         "maintenance_in_rent": listing.maintenance_included_in_rent,
         "rent_negotiable": listing.rent_amount_negotiable,
@@ -408,9 +788,18 @@ def get_single_listing(listing_id: str, db: Session = Depends(get_db)):
         "prefer_text": listing.prefers_text,
     }
 
+    cache_listing(cache_key, result)
 
-@router.post("/listings", status_code=status.HTTP_201_CREATED)
+    return result
+
+
+@router.post(
+    "/listings",
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(require_user)],
+)
 def create_listing(
+    background_task: BackgroundTasks,
     title: str = Form(...),
     listing_type: str = Form(...),
     available_from: str = Form(...),
@@ -441,12 +830,8 @@ def create_listing(
     apartment_id: UUID = Form(...),
     images: Optional[List[UploadFile]] = Form([]),
     db: Session = Depends(get_db),
-    authorization: Optional[str] = Header(None),
 ):
-    if not verify_id_from_token(authorization, db):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired"
-        )
+    uploads = read_uploaded_images(images)
 
     try:
         new_listing = Listing(
@@ -476,15 +861,17 @@ def create_listing(
             whatsapp_number=whatsapp_number,
             prefers_call=prefers_call,
             prefers_text=prefers_text,
-            user_id=str(user_id),
-            apartment_id=str(apartment_id),
+            user_id=user_id,
+            apartment_id=apartment_id,
         )
 
         db.add(new_listing)
         db.commit()
 
-        if new_listing.id and images:
-            upload_image_to_imagekit(new_listing.id, images, db)
+        invalidate_listing_caches(new_listing.id)
+
+        if new_listing.id and uploads:
+            background_task.add_task(upload_image_to_imagekit, new_listing.id, uploads)
 
         return new_listing.id
 
@@ -495,8 +882,13 @@ def create_listing(
         )
 
 
-@router.put("/listings", status_code=status.HTTP_201_CREATED)
+@router.put(
+    "/listings",
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(require_user)],
+)
 def update_listing(
+    background_task: BackgroundTasks,
     listing_id: str = Form(...),
     title: str = Form(...),
     listing_type: str = Form(...),
@@ -526,49 +918,50 @@ def update_listing(
     prefers_text: Optional[bool] = Form(...),
     images: Optional[List[UploadFile]] = Form([]),
     db: Session = Depends(get_db),
-    authorization: Optional[str] = Header(None),
 ):
-    if not verify_id_from_token(authorization, db):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired"
-        )
+    uploads = read_uploaded_images(images)
 
     try:
-        db.query(Listing).filter(Listing.id == listing_id).update(
-            {
-                Listing.title: title,
-                Listing.listing_type: listing_type,
-                Listing.total_area: total_area,
-                Listing.description: description or None,
-                Listing.mobile_number: mobile_number,
-                Listing.bedrooms: bedrooms,
-                Listing.bathrooms: bathrooms,
-                Listing.floors: floors,
-                Listing.whatsapp_number: whatsapp_number,
-                Listing.parking_available: parking_available,
-                Listing.pets_allowed: pets_allowed,
-                Listing.available_from: available_from,
-                Listing.total_floors: total_floors,
-                Listing.rent_amount: rent_amount,
-                Listing.maintenance_included_in_rent: maintenance_included_in_rent,
-                Listing.rent_amount_negotiable: rent_amount_negotiable,
-                Listing.deposit_amount: deposit_amount,
-                Listing.maintenance_amount: maintenance_amount,
-                Listing.sale_amount: sale_amount,
-                Listing.sale_amount_value: sale_amount_value,
-                Listing.sale_amount_negotiable: sale_amount_negotiable,
-                Listing.facing_direction: facing_direction or None,
-                Listing.tenant_preference: tenant_preference or None,
-                Listing.non_vegetarians: non_vegetarians,
-                Listing.prefers_call: prefers_call,
-                Listing.prefers_text: prefers_text,
-            }
+        db.execute(
+            update(Listing)
+            .where(Listing.id == listing_id)
+            .values(
+                title=title,
+                listing_type=listing_type,
+                total_area=total_area,
+                description=description or None,
+                mobile_number=mobile_number,
+                bedrooms=bedrooms,
+                bathrooms=bathrooms,
+                floors=floors,
+                whatsapp_number=whatsapp_number,
+                parking_available=parking_available,
+                pets_allowed=pets_allowed,
+                available_from=available_from,
+                total_floors=total_floors,
+                rent_amount=rent_amount,
+                maintenance_included_in_rent=maintenance_included_in_rent,
+                rent_amount_negotiable=rent_amount_negotiable,
+                deposit_amount=deposit_amount,
+                maintenance_amount=maintenance_amount,
+                sale_amount=sale_amount,
+                sale_amount_value=sale_amount_value,
+                sale_amount_negotiable=sale_amount_negotiable,
+                facing_direction=facing_direction or None,
+                tenant_preference=tenant_preference or None,
+                non_vegetarians=non_vegetarians,
+                prefers_call=prefers_call,
+                prefers_text=prefers_text,
+            )
+            .execution_options(synchronize_session=False)
         )
 
         db.commit()
 
-        if images:
-            upload_image_to_imagekit(listing_id, images, db)
+        invalidate_listing_caches(listing_id)
+
+        if uploads:
+            background_task.add_task(upload_image_to_imagekit, listing_id, uploads)
 
         return listing_id
 
@@ -579,17 +972,15 @@ def update_listing(
         )
 
 
-@router.delete("/listing/{listing_id}", status_code=status.HTTP_201_CREATED)
+@router.delete(
+    "/listing/{listing_id}",
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(require_user)],
+)
 def delete_listing(
     listing_id: str,
     db: Session = Depends(get_db),
-    authorization: Optional[str] = Header(None),
 ):
-    if not verify_id_from_token(authorization, db):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired"
-        )
-
     try:
         delete_selected_listing(listing_id, db)
 
@@ -601,17 +992,24 @@ def delete_listing(
 
 
 @router.get("/listings/apartment/{apartment}", status_code=status.HTTP_200_OK)
-def get_all_listings_for_apartment(apartment: str, db: Session = Depends(get_db)):
+def get_all_listings_for_apartment(
+    apartment: str,
+    request: Request,
+    db: Session = Depends(get_db),
+):
     """
     Returns a single listing
 
     Parameters
     ----------
+    apartment : str
+    request : Request
     db : Session
 
     Returns
     -------
-    Data for a single apartment based on the ListingBase model
+    Data for a single apartment based on the ListingBase model, or an empty
+    304 response when the client's If-None-Match matches the current ETag
 
     Raises
     ------
@@ -619,30 +1017,82 @@ def get_all_listings_for_apartment(apartment: str, db: Session = Depends(get_db)
 
     """
     try:
-        records = get_listings_for_apartment(apartment, db)
+        cache_key = ("apartment", apartment)
+
+        listings = get_cached_listings(cache_key)
+
+        if listings is not None:
+            return conditional_response(request, listings)
+
+        records = get_listing_summaries_for_apartment(apartment, db)
+        today = date.today()
+
+        listings = [
+            build_listing_summary(record, record.images, today) for record in records
+        ]
+
+        cache_listings(cache_key, listings)
+
+        return conditional_response(request, listings)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Could not fetch the listing",
+        )
+
+
+@router.get("/listings/filter/{apartment}", status_code=status.HTTP_200_OK)
+def filter_apartment_listings(
+    apartment: str,
+    request: Request,
+    type_of_listing: Optional[str] = None,
+    bedrooms: Optional[str] = None,
+    min_bedrooms: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Returns listings for an apartment based on the query parameters
+
+    Parameters
+    ----------
+    apartment : str
+    request : Request
+    type_of_listing : str, optional
+    bedrooms : str, optional
+        An exact count, or "3%2B" for more than three bedrooms
+    min_bedrooms : int, optional
+    db : Session, optional
 
-        listings = []
-        single_listing = {}
+    Returns
+    -------
+    List, or an empty 304 response when the client's If-None-Match matches
+    the current ETag
 
-        # images = get_listing_images(record.id, db)
+    Raises
+    ------
+    HTTPException
+    """
+    exact_bedrooms = None
 
-        for record in records:
-            image_list = get_listing_images(record.id, db)
+    if bedrooms:
+        try:
+            exact_bedrooms, at_least = parse_bedrooms_filter(bedrooms)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid bedrooms filter",
+            )
 
-            single_listing["id"] = record.id
-            single_listing["title"] = record.title
-            single_listing["listing_type"] = record.listing_type
-            single_listing["description"] = record.description
-            single_listing["bedrooms"] = record.bedrooms
-            single_listing["date_created"] = date_formatter(record.date_created)
-            single_listing["images"] = image_list
-            single_listing["rent"] = record.rent_amount
-            single_listing["sale"] = record.sale_amount
-            single_listing["sale_amount_value"] = record.sale_amount_value
+        if at_least is not None:
+            min_bedrooms = max(at_least, min_bedrooms or 0)
 
-            listings.append(single_listing.copy())
+    try:
+        listings = get_filtered_listings(
+            type_of_listing, exact_bedrooms, apartment, db, min_bedrooms
+        )
+
+        return conditional_response(request, listings)
 
-        return listings
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -651,7 +1101,9 @@ def get_all_listings_for_apartment(apartment: str, db: Session = Depends(get_db)
 
 
 @router.get(
-    "/listings/filter/{listing_filter}/{apartment}", status_code=status.HTTP_200_OK
+    "/listings/filter/{listing_filter}/{apartment}",
+    status_code=status.HTTP_200_OK,
+    deprecated=True,
 )
 def filter_listings_for_apartment(
     listing_filter: str, apartment: str, db: Session = Depends(get_db)
@@ -659,6 +1111,8 @@ def filter_listings_for_apartment(
     """
     Returns listings for an apartment based on the filter
 
+    Kept for existing clients, use /listings/filter/{apartment} instead
+
     Parameters
     ----------
     listing_filter : str
@@ -674,33 +1128,24 @@ def filter_listings_for_apartment(
     HTTPException
     """
     try:
-        filtered_results = []
-        filtered_result_obj = {}
-
-        filters_dict = json.loads(listing_filter)
-
-        type_of_listing = filters_dict["typeOfListing"]
-        bedrooms = filters_dict["bedrooms"]
+        filters_dict = orjson.loads(listing_filter)
+        bedrooms, min_bedrooms = None, None
 
-        if not type_of_listing and not bedrooms:
-            return get_listings_for_apartment(apartment, db)
-
-        records = filter_listings(type_of_listing, bedrooms, apartment, db)
+        if filters_dict["bedrooms"]:
+            bedrooms, min_bedrooms = parse_bedrooms_filter(
+                str(filters_dict["bedrooms"])
+            )
 
-        for record in records:
-            images = get_listing_images(record.id, db)
-            filtered_result_obj["id"] = record.id
-            filtered_result_obj["title"] = record.title
-            filtered_result_obj["listing_type"] = record.listing_type
-            filtered_result_obj["description"] = record.description
-            filtered_result_obj["bedrooms"] = record.bedrooms
-            filtered_result_obj["date_created"] = date_formatter(record.date_created)
-            filtered_result_obj["images"] = images
-            filtered_result_obj["rent"] = record.rent_amount
-            filtered_result_obj["sale"] = record.sale_amount
-            filtered_results.append(filtered_result_obj.copy())
+        return get_filtered_listings(
+            filters_dict["typeOfListing"], bedrooms, apartment, db, min_bedrooms
+        )
 
-        return filtered_results
+    except ValueError:
+        # Also covers orjson's JSONDecodeError for a malformed filter
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid listing filter",
+        )
 
     except Exception:
         raise HTTPException(
@@ -709,17 +1154,15 @@ def filter_listings_for_apartment(
         )
 
 
-@router.delete("/image/{file_id}", status_code=status.HTTP_201_CREATED)
+@router.delete(
+    "/image/{file_id}",
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(require_user)],
+)
 def remove_image_from_imagekit(
     file_id: str,
     db: Session = Depends(get_db),
-    authorization: Optional[str] = Header(None),
 ):
-    if not verify_id_from_token(authorization, db):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired"
-        )
-
     imagekit = initialize_imagekit()
 
     delete_image = imagekit.delete_file(file_id)
@@ -727,3 +1170,5 @@ def remove_image_from_imagekit(
     if not delete_image["error"]:
         db.query(ListingImage).filter(ListingImage.imagekit_file_id == file_id).delete()
         db.commit()
+
+        invalidate_listing_caches()
@@ -2,25 +2,43 @@ from typing import List
 from typing import Optional
 from uuid import UUID
 
+from fastapi import BackgroundTasks
 from fastapi import Header
 from fastapi import HTTPException
 from fastapi import status
 from fastapi.param_functions import Depends
-from passlib.hash import pbkdf2_sha256
 from pydantic import BaseModel
 from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm import raiseload
+from sqlalchemy.orm import selectinload
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
+from . import get_async_db
 from . import get_db
+from . import require_user
 from . import router
 from .auth import create_access_token
+from .auth import run_in_hash_pool
 from database.models import Apartment
 from database.models import Listing
 from database.models import ListingImage
 from database.models import User
+from helpers.imagekit_init import delete_imagekit_files
+from helpers.listing_cache import cache_user_listings
+from helpers.listing_cache import get_cached_user_listings
+from helpers.listing_cache import invalidate_listing_caches
+from helpers.passwords import get_password_hash
+from helpers.token_verification import forget_current_user
+from helpers.token_verification import forget_user
 from helpers.token_verification import verify_id_from_token
 from helpers.uuid_validator import uuid_validator
-from routers.listings import delete_selected_listing
 
 
 class UserBase(BaseModel):
@@ -63,138 +81,180 @@ class UserUpdate(BaseModel):
         orm_mode = True
 
 
-def create_new_user(user: UserRegister, db: Session):
+def create_new_user(user: UserRegister, password_hash: str, db: Session):
     new_user = User(
         name=user.name.title(),
-        email=user.email.lower(),
-        password=pbkdf2_sha256.hash(user.password),
+        email=user.email,
+        password=password_hash,
     )
 
     db.add(new_user)
+    # Only flushed, so nothing is committed if building the token fails. The
+    # dict is read before the commit expires the instance, so nothing is
+    # queried from the event loop afterwards either
+    db.flush()
+
+    registered_user = {
+        "id": new_user.id,
+        "name": new_user.name,
+        "email": new_user.email,
+        "token": create_access_token(data={"sub": str(new_user.id)}),
+    }
+
     db.commit()
 
-    return new_user
+    return registered_user
 
 
 def check_for_existing_email(email: str, db: Session):
-    return db.query(User).filter(User.email == email.lower()).first()
+    return db.query(
+        db.query(User.id).filter(func.lower(User.email) == email.lower()).exists()
+    ).scalar()
 
 
 def fetch_user_from_id(id: UUID, db: Session):
-    return db.query(User).filter(User.id == id).first()
-
-
-def get_listings_for_a_user(user_id: str, db: Session):
-    return (
-        db.query(
-            Listing.id,
-            Listing.title,
-            Listing.listing_type,
-            Apartment.name.label("apartment"),
-        )
-        .join(Apartment, Listing.apartment_id == Apartment.id)
-        .filter(Listing.user_id == user_id)
-        .all()
-    )
-
-
-def get_listing_images(listing_id, db):
-    return (
-        db.query(
-            ListingImage.image_path,
-            ListingImage.thumbnail_url,
-            ListingImage.height,
-            ListingImage.width,
+    # Served from the session's identity map when the user is already loaded
+    return db.get(User, id)
+
+
+async def get_listings_for_a_user(user_id: str, db: AsyncSession):
+    # The images of every listing come from one extra SELECT. Any other
+    # relationship touched while building the response raises instead of
+    # quietly issuing a query per listing
+    result = await db.execute(
+        select(Listing)
+        .options(
+            load_only(Listing.id, Listing.title, Listing.listing_type),
+            joinedload(Listing.apartment, innerjoin=True).load_only(Apartment.name),
+            selectinload(Listing.images).load_only(
+                ListingImage.image_path,
+                ListingImage.thumbnail_url,
+                ListingImage.height,
+                ListingImage.width,
+            ),
+            raiseload("*"),
         )
-        .filter(ListingImage.listing_id == str(listing_id))
-        .all()
+        .where(Listing.user_id == UUID(user_id))
     )
+    return result.scalars().all()
 
 
-def get_dashboard_information_for_a_user(user_id: str, db: Session):
-    return (
-        db.query(
+async def get_dashboard_information_for_a_user(user_id: str, db: AsyncSession):
+    result = await db.execute(
+        select(
             func.count(Listing.user_id).label("count"),
             Apartment.name.label("apartment"),
         )
         .join(Apartment, Listing.apartment_id == Apartment.id)
-        .filter(Listing.user_id == user_id)
+        .where(Listing.user_id == UUID(user_id))
         .group_by(Apartment.name)
-        .all()
     )
+    return result.all()
 
 
 def update_user_information(id: UUID, name: str, db: Session):
-    db.query(User).filter(User.id == id).update({User.name: name})
+    # The updated row comes back from the UPDATE itself
+    record = db.execute(
+        update(User)
+        .where(User.id == id)
+        .values(name=name)
+        .returning(User.name, User.id, User.email)
+        .execution_options(synchronize_session=False)
+    ).first()
 
     db.commit()
 
-    return db.query(User.name, User.id, User.email).filter(User.id == id).first()
+    forget_current_user(id)
+    # Cached listings carry the user's name
+    invalidate_listing_caches()
 
+    return record
 
-def delete_selected_user(user_id: str, db: Session):
-    listing_ids = db.query(Listing.id).filter(Listing.user_id == user_id).all()
 
-    if len(listing_ids) != 0:
-        for id in listing_ids:
-            delete_selected_listing(str(id[0]), db)
+def delete_selected_user(user_id: str, db: Session):
+    # Every listing and image of the user goes in one statement each, in a
+    # single transaction. The ImageKit file ids are returned so the files
+    # can be removed after the response
+    listing_ids = select(Listing.id).where(Listing.user_id == user_id)
+
+    file_ids = [
+        image.imagekit_file_id
+        for image in db.query(ListingImage.imagekit_file_id)
+        .filter(ListingImage.listing_id.in_(listing_ids))
+        .all()
+    ]
 
-    db.query(User).filter(User.id == user_id).delete()
+    db.query(ListingImage).filter(ListingImage.listing_id.in_(listing_ids)).delete(
+        synchronize_session=False
+    )
+    db.query(Listing).filter(Listing.user_id == user_id).delete(
+        synchronize_session=False
+    )
+    db.query(User).filter(User.id == user_id).delete(synchronize_session=False)
 
     db.commit()
 
-    return "User deleted"
+    forget_user(user_id)
+    invalidate_listing_caches()
 
+    return file_ids
 
-def user_from_id(id: str, db: Session):
-    return db.query(User).filter(User.id == id).first()
 
+async def user_from_id(id: str, db: AsyncSession):
+    result = await db.execute(select(User.id).where(User.id == UUID(id)))
+    return result.first()
 
-def verification_status(id: str, db: Session):
-    record = db.query(User).filter(User.id == id).update({User.verify_user: True})
 
-    db.commit()
+async def verification_status(id: str, db: AsyncSession):
+    result = await db.execute(
+        update(User)
+        .where(User.id == UUID(id))
+        .values(verify_user=True)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
 
-    return record
+    forget_current_user(id)
 
+    return result.rowcount
 
-def email_send_count(id: str, db: Session):
-    record = (
-        db.query(User.verification_email_resend_count).filter(User.id == id).first()
-    )
 
-    count = (
-        db.query(User)
-        .filter(User.id == id)
-        .update({User.verification_email_resend_count: int(record[0]) + 1})
+async def email_send_count(id: str, db: AsyncSession):
+    # Incremented by Postgres, so there is no read before the write
+    result = await db.execute(
+        update(User)
+        .where(User.id == UUID(id))
+        .values(
+            verification_email_resend_count=func.coalesce(
+                User.verification_email_resend_count, 0
+            )
+            + 1
+        )
+        .execution_options(synchronize_session=False)
     )
+    await db.commit()
 
-    db.commit()
-
-    return count
+    return result.rowcount
 
 
 @router.post("/user", status_code=status.HTTP_201_CREATED)
-def register_user(user: UserRegister, db: Session = Depends(get_db)):
+async def register_user(user: UserRegister, db: Session = Depends(get_db)):
+    email_exists = HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail=f"An user for {user.email} already exists. Please register with a different email address.",
+    )
 
-    record = check_for_existing_email(user.email, db)
-    if record:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"An user for {user.email} already exists. Please register with a different email address.",
-        )
+    # Checked before hashing so a duplicate costs no hash
+    if await run_in_threadpool(check_for_existing_email, user.email, db):
+        raise email_exists
 
     try:
-        record = create_new_user(user, db)
-        token = create_access_token(data={"sub": str(record.id)})
-
-        return {
-            "id": record.id,
-            "name": record.name,
-            "email": record.email,
-            "token": token,
-        }
+        password_hash = await run_in_hash_pool(get_password_hash, user.password)
+        return await run_in_threadpool(create_new_user, user, password_hash, db)
 
+    except IntegrityError:
+        # A concurrent registration took the email after the check above
+        raise email_exists
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -221,17 +281,15 @@ def get_individual_user(
         )
 
 
-@router.put("/user/update", status_code=status.HTTP_201_CREATED)
+@router.put(
+    "/user/update",
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(require_user)],
+)
 def update_user_profile(
     user: UserUpdate,
     db: Session = Depends(get_db),
-    authorization: Optional[str] = Header(None),
 ):
-    if not verify_id_from_token(authorization, db):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Token expired"
-        )
-
     try:
         return update_user_information(user.id, user.name, db)
 
@@ -247,43 +305,38 @@ def update_user_profile(
     # response_model=List[UserListing],
     status_code=status.HTTP_200_OK,
 )
-def get_user_listings(user_id: str, db: Session = Depends(get_db)):
+async def get_user_listings(user_id: str, db: AsyncSession = Depends(get_async_db)):
     try:
-        image_list = []
-        listings_list = []
-        image_obj = {}
-        listing_obj = {}
-
-        listings = get_listings_for_a_user(user_id, db)
-
-        if not listings:
-            return []
-
-        for listing in listings:
-
-            listing_obj["id"] = listing.id
-            listing_obj["title"] = listing.title
-            listing_obj["listing_type"] = listing.listing_type
-            listing_obj["apartment"] = listing.apartment
-
-            images = get_listing_images(listing.id, db)
-
-            if len(images) == 0:
-                listing_obj["images"] = []
-
-            for image in images:
-
-                image_obj["image_url"] = image[0]
-                image_obj["image_thumbnail"] = image[1]
-                image_obj["height"] = image[2]
-                image_obj["width"] = image[3]
-                image_list.append(image_obj.copy())
-                listing_obj["images"] = image_list
-                image_list = []
-
-            listings_list.append(listing_obj.copy())
-
-        return listings_list
+        cache_key = ("listings", user_id)
+        cached = get_cached_user_listings(cache_key)
+
+        if cached is not None:
+            return cached
+
+        listings = await get_listings_for_a_user(user_id, db)
+
+        result = [
+            {
+                "id": listing.id,
+                "title": listing.title,
+                "listing_type": listing.listing_type,
+                "apartment": listing.apartment.name,
+                "images": [
+                    {
+                        "image_url": image.image_path,
+                        "image_thumbnail": image.thumbnail_url,
+                        "height": image.height,
+                        "width": image.width,
+                    }
+                    for image in listing.images
+                ],
+            }
+            for listing in listings
+        ]
+
+        cache_user_listings(cache_key, result)
+
+        return result
 
     except Exception:
         raise HTTPException(
@@ -297,9 +350,24 @@ def get_user_listings(user_id: str, db: Session = Depends(get_db)):
     response_model=List[UserDashboard],
     status_code=status.HTTP_200_OK,
 )
-def get_user_dashboard_data(user_id: str, db: Session = Depends(get_db)):
+async def get_user_dashboard_data(
+    user_id: str, db: AsyncSession = Depends(get_async_db)
+):
     try:
-        return get_dashboard_information_for_a_user(user_id, db)
+        cache_key = ("dashboard", user_id)
+        cached = get_cached_user_listings(cache_key)
+
+        if cached is not None:
+            return cached
+
+        result = [
+            dict(row._mapping)
+            for row in await get_dashboard_information_for_a_user(user_id, db)
+        ]
+
+        cache_user_listings(cache_key, result)
+
+        return result
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -308,9 +376,16 @@ def get_user_dashboard_data(user_id: str, db: Session = Depends(get_db)):
 
 
 @router.delete("/user/delete/{user_id}", status_code=status.HTTP_201_CREATED)
-def delete_user(user_id: str, db: Session = Depends(get_db)):
+def delete_user(
+    background_task: BackgroundTasks, user_id: str, db: Session = Depends(get_db)
+):
     try:
-        return delete_selected_user(user_id, db)
+        file_ids = delete_selected_user(user_id, db)
+
+        if file_ids:
+            background_task.add_task(delete_imagekit_files, file_ids)
+
+        return "User deleted"
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -319,12 +394,12 @@ def delete_user(user_id: str, db: Session = Depends(get_db)):
 
 
 @router.get("/user/verify/{id}", status_code=status.HTTP_200_OK)
-async def verify_if_user_exists(id: str, db: Session = Depends(get_db)):
+async def verify_if_user_exists(id: str, db: AsyncSession = Depends(get_async_db)):
     try:
         valid_uuid = uuid_validator(id)
 
         if valid_uuid:
-            return bool(user_from_id(id, db))
+            return bool(await user_from_id(id, db))
         else:
             return False
     except Exception:
@@ -335,12 +410,12 @@ async def verify_if_user_exists(id: str, db: Session = Depends(get_db)):
 
 
 @router.put("/user/verify/{id}", status_code=status.HTTP_201_CREATED)
-async def update_verification_status(id: str, db: Session = Depends(get_db)):
+async def update_verification_status(id: str, db: AsyncSession = Depends(get_async_db)):
     try:
         valid_uuid = uuid_validator(id)
 
         if valid_uuid:
-            return verification_status(id, db)
+            return await verification_status(id, db)
         else:
             return False
     except Exception:
@@ -351,12 +426,12 @@ async def update_verification_status(id: str, db: Session = Depends(get_db)):
 
 
 @router.put("/user/email_count/{id}", status_code=status.HTTP_201_CREATED)
-async def update_email_send_count(id: str, db: Session = Depends(get_db)):
+async def update_email_send_count(id: str, db: AsyncSession = Depends(get_async_db)):
     try:
         valid_uuid = uuid_validator(id)
 
         if valid_uuid:
-            return email_send_count(id, db)
+            return await email_send_count(id, db)
         else:
             return False
     except Exception: